@@ -8,7 +8,6 @@ from src import exemplars, milan, milannotations
 from src.utils import ablations, env, training, viz
 from src.utils.typing import StrSequence
 
-import numpy as np
 import spacy
 import torch
 import wandb
@@ -332,8 +331,9 @@ for dataset_name in args.datasets:
                     indices = sorted(range(len(descriptions)),
                                      key=lambda i: scores[i],
                                      reverse=order == ORDER_DECREASING)
-                    fractions = np.arange(args.ablation_min, args.ablation_max,
-                                          args.ablation_step_size)
+                    fractions = training.step_grid(
+                        args.ablation_min, args.ablation_max,
+                        args.ablation_step_size)
                     for fraction in fractions:
                         ablated = indices[:int(fraction * len(indices))]
                         units = dissected.units(ablated)
@@ -3,17 +3,19 @@ import argparse
 import copy
 import pathlib
 import random
+import re
 import shutil
+from typing import ContextManager
 
 from src import exemplars, milan, milannotations
 from src.deps.netdissect import renormalize
 from src.utils import ablations, env, training, viz
 from src.utils.typing import StrSequence
 
+import numpy
 import torch
 import wandb
 from torch import cuda
-from tqdm.auto import tqdm
 
 EXPERIMENTS = (
     exemplars.datasets.KEYS.IMAGENET_SPURIOUS_TEXT,
@@ -112,6 +114,7 @@ parser.add_argument('--lr',
                     default=1e-4,
                     help='learning rate (default: 1e-4)')
 parser.add_argument('--ablation-min',
+                    type=int,
                     default=0,
                     help='min number of neurons to ablate (default: 0)')
 parser.add_argument('--ablation-max',
@@ -119,8 +122,19 @@ parser.add_argument('--ablation-max',
                     default=50,
                     help='max number of neurons to ablate (default: 50)')
 parser.add_argument('--ablation-step-size',
+                    type=int,
                     default=1,
                     help='add\'l neurons to ablate at each step (default: 1)')
+parser.add_argument(
+    '--ablations-per-batch',
+    type=int,
+    default=16,
+    help='evaluate this many ablations in parallel in each forward pass; '
+    'halved automatically if the GPU runs out of memory (default: 16)')
+parser.add_argument('--num-workers',
+                    type=int,
+                    default=0,
+                    help='number of data loader workers (default: 0)')
 parser.add_argument('--device', help='manually set device (default: guessed)')
 parser.add_argument('--wandb-project',
                     default='milan',
@@ -147,6 +161,25 @@ wandb.init(project=args.wandb_project,
 
 device = args.device or 'cuda' if cuda.is_available() else 'cpu'
 
+
+def cudnn_benchmark() -> ContextManager[None]:
+    """Let cudnn benchmark kernels for each new input shape, then restore.
+
+    Only the ablation sweeps use this. They run thousands of forward passes
+    over a handful of input shapes (full and partial batches, tiled once per
+    ablation in a chunk), so benchmarking each shape once pays for itself.
+    Training, dissection, and fine-tuning keep the default kernel choice.
+    """
+    return torch.backends.cudnn.flags(
+        enabled=torch.backends.cudnn.enabled,
+        benchmark=True,
+        deterministic=torch.backends.cudnn.deterministic,
+        allow_tf32=torch.backends.cudnn.allow_tf32)
+
+
+# Pinned host memory lets batches copy to the GPU while the last one runs.
+pin_memory = str(device).startswith('cuda')
+
 # Prepare necessary directories.
 data_dir = args.data_dir or env.data_dir()
 
@@ -177,6 +210,10 @@ for experiment in args.experiments:
         target_words = ('red', 'yellow', 'green', 'blue', 'cyan', 'purple',
                         'brown', 'black', 'white', 'gray')
 
+    # Match all target words, in any case, in a single scan.
+    target_pattern = re.compile('|'.join(map(re.escape, target_words)),
+                                flags=re.IGNORECASE)
+
     for version in args.versions:
         print(f'\n-------- BEGIN EXPERIMENT: {experiment}/{version} --------')
 
@@ -224,7 +261,8 @@ for experiment in args.experiments:
                     max_epochs=args.epochs,
                     patience=args.patience,
                     optimizer_kwargs={'lr': args.lr},
-                    num_workers=0,
+                    num_workers=args.num_workers,
+                    pin_memory=pin_memory,
                     device=device,
                     display_progress_as=f'train {args.cnn}')
             print(f'saving trained {args.cnn} to {cnn_file}')
@@ -234,14 +272,19 @@ for experiment in args.experiments:
         # Now that we have the trained model, dissect it on the validation set.
         dissection_dir = experiment_dir / f'{args.cnn}-{version}'
         for layer in layers:
+            layer_dir = dissection_dir / layer
+            if all((layer_dir / name).exists()
+                   for name in ('images.npy', 'masks.npy')):
+                print(f'found cached dissection for {layer} in {layer_dir}')
+                continue
             print(f'dissecting: {layer}')
             exemplars.discriminative(
                 cnn.model,
                 val,
                 layer=layer,
                 results_dir=dissection_dir,
-                tally_cache_file=dissection_dir / layer / 'tally.npz',
-                masks_cache_file=dissection_dir / layer / 'masks.npz',
+                tally_cache_file=layer_dir / 'tally.npz',
+                masks_cache_file=layer_dir / 'masks.npz',
                 device=device,
                 # Have to manually set these since they cannot be inferred
                 # from our custom dataset type.
@@ -255,7 +298,15 @@ for experiment in args.experiments:
         if descriptions_file.exists():
             print(f'loading cached descriptions from {descriptions_file}')
             with descriptions_file.open('r') as handle:
-                descriptions = handle.read().split('\n')
+                lines = list(handle)
+            descriptions = [line.rstrip('\n') for line in lines]
+            # Older files have no trailing newline, so an empty last
+            # description leaves no line of its own, but the file still ends
+            # in a newline. A file cut off mid-write ends mid-line instead,
+            # so never pad it; let the assert catch it.
+            complete = not lines or lines[-1].endswith('\n')
+            if complete and len(descriptions) == len(dissected) - 1:
+                descriptions.append('')
             assert len(descriptions) == len(dissected)
         else:
             descriptions = decoder.predict(
@@ -266,13 +317,13 @@ for experiment in args.experiments:
                 beam_size=50,
                 device=device)
             print(f'saving descriptions to {descriptions_file}')
-            with descriptions_file.open('w') as handle:
-                handle.write('\n'.join(descriptions))
+            with descriptions_file.open('w', buffering=1 << 20) as handle:
+                handle.writelines(desc + '\n' for desc in descriptions)
 
         # Find candidate spurious neurons, and write them to disk.
         candidate_indices = [
             index for index, description in enumerate(descriptions)
-            if any(word in description.lower() for word in target_words)
+            if target_pattern.search(description)
         ]
         candidates_file = experiment_dir / f'{args.cnn}-{version}-units.txt'
         print(f'found {len(candidate_indices)} candidate units; '
@@ -291,17 +342,34 @@ for experiment in args.experiments:
                 print(f'loading unit scores from {scores_file}')
                 scores = torch.load(scores_file)
             else:
-                scores = []
-                for index in tqdm(range(len(dissected)), desc='score units'):
-                    score = cnn.accuracy(val,
-                                         ablate=[dissected.unit(index)],
-                                         display_progress_as=None,
-                                         num_workers=0,
-                                         device=device)
-                    scores.append(score)
+                units = dissected.units(range(len(dissected)))
+                with cudnn_benchmark():
+                    scores = cnn.accuracy_ablations(
+                        val,
+                        [[unit] for unit in units],
+                        ablations_per_batch=args.ablations_per_batch,
+                        display_progress_as='score units',
+                        num_workers=args.num_workers,
+                        pin_memory=pin_memory,
+                        device=device)
                 print(f'saving unit scores to {scores_file}')
                 torch.save(scores, scores_file)
 
+        # Rank units by score once; both sorted conditions read from this.
+        order = None
+        if scores is not None:
+            order = numpy.argsort(-numpy.asarray(scores), kind='stable')
+
+        # Fine tuning changes the weights, so snapshot them once and restore
+        # them into a single copy of the model before each fine tuning run.
+        fine_tuned, weights = None, None
+        if args.fine_tune:
+            fine_tuned = copy.deepcopy(cnn)
+            weights = {
+                key: value.detach().cpu().clone()
+                for key, value in cnn.state_dict().items()
+            }
+
         # Compute its baseline accuracy on the test set.
         for condition in args.conditions:
             if condition == CONDITION_RANDOM:
@@ -311,15 +379,12 @@ for experiment in args.experiments:
 
             for trial in range(1, trials + 1):
                 if condition == CONDITION_SORT_SPURIOUS:
-                    assert scores is not None
-                    indices = sorted(candidate_indices,
-                                     key=scores.__getitem__,
-                                     reverse=True)
+                    assert order is not None
+                    spurious = numpy.isin(order, candidate_indices)
+                    indices = order[spurious].tolist()
                 elif condition == CONDITION_SORT_ALL:
-                    assert scores is not None
-                    indices = sorted(range(len(dissected)),
-                                     key=scores.__getitem__,
-                                     reverse=True)[:len(candidate_indices)]
+                    assert order is not None
+                    indices = order[:len(candidate_indices)].tolist()
                 else:
                     assert condition == CONDITION_RANDOM
                     indices = random.sample(range(len(dissected)),
@@ -328,35 +393,65 @@ for experiment in args.experiments:
                 ns_to_ablate = range(
                     args.ablation_min, args.ablation_max or
                     len(candidate_indices), args.ablation_step_size)
-                for n_ablated in ns_to_ablate:
+
+                # Without fine tuning, the ablation steps are independent,
+                # so evaluate all of them in parallel up front.
+                precomputed = {}
+                if not args.fine_tune:
+                    steps = [
+                        dissected.units(indices[:n]) for n in ns_to_ablate
+                    ]
+                    for key, evaluation in (('val', val), ('test', test)):
+                        with cudnn_benchmark():
+                            precomputed[key] = cnn.accuracy_ablations(
+                                evaluation,
+                                steps,
+                                ablations_per_batch=args.ablations_per_batch,
+                                display_progress_as=f'compute {key} '
+                                f'accuracies (cond={condition}, t={trial})',
+                                num_workers=args.num_workers,
+                                pin_memory=pin_memory,
+                                device=device)
+
+                for step, n_ablated in enumerate(ns_to_ablate):
                     ablated_indices = indices[:n_ablated]
-                    copied = copy.deepcopy(cnn)
-                    if args.fine_tune:
-                        copied.fit(
+                    if not args.fine_tune:
+                        accuracies = {
+                            key: values[step]
+                            for key, values in precomputed.items()
+                        }
+                    else:
+                        assert fine_tuned is not None and weights is not None
+                        ablated_units = dissected.units(ablated_indices)
+                        fine_tuned.load_state_dict(weights)
+                        fine_tuned.fit(
                             dataset,
                             hold_out=val.indices,
                             batch_size=args.batch_size,
                             max_epochs=args.epochs,
                             patience=args.patience,
                             optimizer_kwargs={'lr': args.lr},
-                            ablate=dissected.units(ablated_indices),
+                            ablate=ablated_units,
                             layers=['fc']
                             if args.cnn == exemplars.models.KEYS.RESNET18 else
                             ['fc6', 'fc7', 'linear8'],
-                            num_workers=0,
+                            num_workers=args.num_workers,
+                            pin_memory=pin_memory,
                             device=device,
                             display_progress_as=f'fine tune {args.cnn} '
                             f'(cond={condition}, t={trial}, n={n_ablated})')
-                    accuracies = {}
-                    for key, evaluation in (('val', val), ('test', test)):
-                        accuracies[key] = copied.accuracy(
-                            evaluation,
-                            ablate=dissected.units(ablated_indices),
-                            display_progress_as=f'compute {key} accuracy '
-                            f'(cond={condition}, t={trial}, n={n_ablated})',
-                            num_workers=0,
-                            device=device,
-                        )
+                        accuracies = {}
+                        for key, evaluation in (('val', val), ('test', test)):
+                            accuracies[key] = fine_tuned.accuracy(
+                                evaluation,
+                                ablate=ablated_units,
+                                display_progress_as=f'compute {key} accuracy '
+                                f'(cond={condition}, t={trial}, '
+                                f'n={n_ablated})',
+                                num_workers=args.num_workers,
+                                pin_memory=pin_memory,
+                                device=device,
+                            )
                     samples = viz.random_neuron_wandb_images(
                         dissected,
                         descriptions,
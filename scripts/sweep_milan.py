@@ -1,17 +1,19 @@
 """Run a series of sweeps on the captioning model."""
 import argparse
+import contextlib
 import pathlib
 import shutil
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Sequence
 
 from src import milan, milannotations
 from src.deps.ext import bert_score
-from src.utils import env, training, viz
+from src.utils import env, metrics, training, viz
+from src.utils.typing import StrSequence
 
-import numpy
 import torch
 import wandb
 from torch import cuda
+from torch.utils import data
 
 SWEEP_GREEDY = 'greedy'
 SWEEP_BEAM = 'beam'
@@ -74,9 +76,15 @@ parser.add_argument(
     type=float,
     default=.1,
     help='hold out and test on this fraction of data (default: .1)')
-parser.add_argument('--precompute-features',
+parser.add_argument('--no-cache-features',
                     action='store_true',
-                    help='precompute visual features (default: do not)')
+                    help='do not cache visual features in the '
+                    'results dir (default: cache them)')
+parser.add_argument('--autocast-encoder',
+                    action='store_true',
+                    help='featurize images with the encoder in bfloat16 '
+                    'autocast; the decoder still runs in float32 '
+                    '(default: do not)')
 parser.add_argument('--beam-size-min',
                     type=int,
                     default=5,
@@ -183,6 +191,47 @@ elif {SWEEP_GREEDY_MI, SWEEP_BEAM_MI} & set(args.sweeps):
     print(f'saving lm to {lm_file}')
     lm.save(lm_file)
 
+
+def featurize(dataset: data.Subset, name: str) -> data.TensorDataset:
+    """Featurize the dataset, reusing features cached in the results dir.
+
+    Cached features are stored with the split indices they were computed
+    for, and are only reused if those match the current split. Features are
+    always returned on the CPU.
+    """
+    suffix = '-bf16' if args.autocast_encoder else ''
+    features_file = results_dir / f'{name}-features{suffix}.pth'
+    indices = [int(index) for index in dataset.indices]
+    if not args.no_cache_features and features_file.exists():
+        cached = torch.load(features_file, map_location='cpu')
+        if isinstance(cached, dict) and cached['indices'] == indices:
+            print(f'loading cached {name} features from {features_file}')
+            return data.TensorDataset(cached['features'].float())
+        print(f'cached {name} features in {features_file} do not match '
+              f'the {name} split, so recomputing them')
+
+    # Only the encoder runs under autocast. Its features are cached in
+    # bfloat16, but are cast back to float32 before the decoder sees them.
+    autocast: Any = contextlib.nullcontext()
+    if args.autocast_encoder:
+        autocast = torch.autocast(torch.device(device).type,
+                                  dtype=torch.bfloat16)
+    with autocast:
+        mapped = encoder.map(dataset,
+                             device=device,
+                             display_progress_as=f'featurize {name} set')
+    features = mapped.tensors[0].detach().cpu()
+    if args.autocast_encoder:
+        features = features.to(torch.bfloat16)
+    if not args.no_cache_features:
+        print(f'saving {name} features to {features_file}')
+        torch.save({
+            'indices': indices,
+            'features': features,
+        }, features_file)
+    return data.TensorDataset(features.float())
+
+
 decoder_file = results_dir / 'decoder.pth'
 if decoder_file.is_file() and splits_file.is_file():
     print(f'loading cached decoder from {decoder_file}')
@@ -192,41 +241,55 @@ else:
     encoder = milan.encoder(config=config).to(device)
     decoder = milan.decoder(train, encoder, lm=lm).to(device)
 
-    train_features = None
-    if args.precompute_features:
-        train_features = encoder.map(train,
-                                     device=device,
-                                     display_progress_as='featurize train set')
-
+    # Keep the train features on the CPU, and stream them to the device one
+    # batch at a time through pinned memory.
     decoder.fit(train,
-                features=train_features,
+                features=featurize(train, 'train'),
+                pin_memory=str(device).startswith('cuda'),
                 display_progress_as='train decoder',
                 device=device)
 
     print(f'saving decoder to {decoder_file}')
     decoder.save(decoder_file)
 
-test_features = None
-if args.precompute_features:
-    test_features = encoder.map(test,
-                                device=device,
-                                display_progress_as='featurize test set')
+# Every sweep decodes the same test set, so only featurize it once.
+test_features = data.TensorDataset(
+    featurize(test, 'test').tensors[0].to(device))
+
+# Likewise, only preprocess the references and compute IDF weights once.
+bleu_references = None
+if SCORE_BLEU in args.scores:
+    bleu_references = metrics.bleu_references(test)
+
+bert_score_references = None
+if bert_scorer is not None:
+    bert_score_references = metrics.bert_score_references(test)
+    if bert_scorer.idf:
+        bert_scorer.compute_idf(
+            [ref for refs in bert_score_references for ref in refs])
 
 
-def evaluate(**kwargs: Any) -> None:
-    """Evaluate the milan with the given args."""
+def evaluate(predictions: Optional[StrSequence] = None, **kwargs: Any) -> None:
+    """Evaluate the milan with the given args.
+
+    If predictions are given, score those instead of decoding new ones. The
+    args are still logged as the condition that produced them.
+    """
     assert isinstance(decoder, milan.Decoder)
     metadata = viz.kwargs_to_str(**kwargs)
-    predictions = decoder.predict(
-        test,
-        features=test_features,
-        device=device,
-        display_progress_as=f'({metadata}) predict descriptions',
-        **kwargs)
+    if predictions is None:
+        predictions = decoder.predict(
+            test,
+            features=test_features,
+            device=device,
+            display_progress_as=f'({metadata}) predict descriptions',
+            **kwargs)
 
     log: Dict[str, Any] = {'condition': kwargs}
     if SCORE_BLEU in args.scores:
-        bleu = decoder.bleu(test, predictions=predictions)
+        bleu = decoder.bleu(test,
+                            predictions=predictions,
+                            references=bleu_references)
         log['bleu'] = bleu.score
         for index, precision in enumerate(bleu.precisions):
             log[f'bleu-{index + 1}'] = precision
@@ -241,7 +304,9 @@ def evaluate(**kwargs: Any) -> None:
         assert bert_scorer is not None
         bert_scores = decoder.bert_score(test,
                                          predictions=predictions,
-                                         bert_scorer=bert_scorer)
+                                         bert_scorer=bert_scorer,
+                                         references=bert_score_references,
+                                         compute_idf=False)
         for kind, score in bert_scores.items():
             log[f'bert_score-{kind}'] = score
 
@@ -255,35 +320,84 @@ def evaluate(**kwargs: Any) -> None:
     wandb.log(log)
 
 
+# Likelihood beam search does not depend on the temperature, and reranking
+# only reorders its beam, so the beam and rerank sweeps can share one search
+# per beam size. Only hold onto the beams if both sweeps will use them.
+beams: Dict[int, Sequence[milan.DecoderOutput]] = {}
+cache_beams = {SWEEP_BEAM, SWEEP_RERANK} <= set(args.sweeps)
+
+
+def beam_search(beam_size: int) -> Sequence[milan.DecoderOutput]:
+    """Beam search the test set, reusing the beam from an earlier sweep."""
+    if beam_size in beams:
+        return beams[beam_size]
+    outputs = decoder.predict_outputs(
+        test,
+        features=test_features,
+        device=device,
+        display_progress_as=f'(beam_size={beam_size}) beam search',
+        strategy='beam',
+        mi=False,
+        beam_size=beam_size)
+    if cache_beams:
+        beams[beam_size] = outputs
+    return outputs
+
+
+# Build the grids once. Avoid arange for the float grid, since with a float
+# step it can produce one point more or less depending on rounding error.
+beam_sizes = list(
+    range(args.beam_size_min, args.beam_size_max, args.beam_size_step))
+temperatures = training.step_grid(args.mi_temperature_min,
+                                  args.mi_temperature_max,
+                                  args.mi_temperature_step)
+
 for sweep in args.sweeps:
     if sweep == SWEEP_GREEDY:
         evaluate(strategy='greedy', mi=False)
     elif sweep == SWEEP_BEAM:
-        for beam_size in numpy.arange(args.beam_size_min, args.beam_size_max,
-                                      args.beam_size_step):
-            evaluate(strategy='beam', mi=False, beam_size=beam_size)
+        for beam_size in beam_sizes:
+            predictions = [
+                caption for output in beam_search(beam_size)
+                for caption in output.captions
+            ]
+            evaluate(predictions,
+                     strategy='beam',
+                     mi=False,
+                     beam_size=beam_size)
     elif sweep == SWEEP_GREEDY_MI:
-        for temperature in numpy.arange(args.mi_temperature_min,
-                                        args.mi_temperature_max,
-                                        args.mi_temperature_step):
+        for temperature in temperatures:
             evaluate(strategy='greedy', mi=True, temperature=temperature)
     elif sweep == SWEEP_BEAM_MI:
-        for beam_size in numpy.arange(args.beam_size_min, args.beam_size_max,
-                                      args.beam_size_step):
-            for temperature in numpy.arange(args.mi_temperature_min,
-                                            args.mi_temperature_max,
-                                            args.mi_temperature_step):
+        for beam_size in beam_sizes:
+            for temperature in temperatures:
                 evaluate(strategy='beam',
                          beam_size=beam_size,
                          mi=True,
                          temperature=temperature)
     else:
         assert sweep == SWEEP_RERANK
-        for beam_size in numpy.arange(args.beam_size_min, args.beam_size_max,
-                                      args.beam_size_step):
-            for temperature in numpy.arange(args.mi_temperature_min,
-                                            args.mi_temperature_max,
-                                            args.mi_temperature_step):
-                evaluate(strategy='rerank',
+        for beam_size in beam_sizes:
+            # The LM scores do not depend on temperature either, so compute
+            # them once per beam and only redo the cheap argmax below.
+            beam = []
+            for output in beam_search(beam_size):
+                assert output.beam_tokens is not None
+                assert output.beam_scores is not None
+                with torch.no_grad():
+                    scores_lm = decoder.score_lm(output.beam_tokens)
+                beam.append(
+                    (output.beam_tokens, output.beam_scores, scores_lm))
+
+            for temperature in temperatures:
+                predictions = []
+                for tokens, scores, scores_lm in beam:
+                    best, _ = decoder.rerank(tokens,
+                                             scores,
+                                             temperature=temperature,
+                                             scores_lm=scores_lm)
+                    predictions += decoder.indexer.reconstruct(best.tolist())
+                evaluate(predictions,
+                         strategy='rerank',
                          beam_size=beam_size,
                          temperature=temperature)
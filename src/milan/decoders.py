@@ -19,7 +19,6 @@ from src.utils.typing import Device, OptionalTensors, StrSequence
 
 import sacrebleu
 import torch
-from allennlp.nn import beam_search
 from torch import nn, optim
 from torch.distributions import categorical
 from torch.utils import data
@@ -150,68 +149,6 @@ class DecoderOutput(NamedTuple):
     beam_tokens: Optional[torch.Tensor]
 
 
-class AllenNLPDecoderState(dict):
-    """Wraps decoder state for AllenNLP implementation of beam search."""
-
-    def __init__(self, features: torch.Tensor, state: DecoderState,
-                 **kwargs: Any):
-        """Initialize the state.
-
-        Args:
-            features (torch.Tensor): Image features.
-            state (DecoderState): Current decoder state.
-
-        """
-        kvs = {
-            'features': features,
-            'h': state.h,
-            'c': state.c,
-        }
-        # Only add LM states if they are present. Also force the batch
-        # dimension to go first.
-        if state.h_lm is not None:
-            kvs['h_lm'] = state.h_lm.permute(1, 0, 2).contiguous()
-        if state.c_lm is not None:
-            kvs['c_lm'] = state.c_lm.permute(1, 0, 2).contiguous()
-        super().__init__(**kvs, **kwargs)
-
-    @property
-    def features(self) -> torch.Tensor:
-        """Return the visual features, asserting they are present."""
-        features = self.get('features')
-        assert features is not None, 'features missing from state?'
-        return features
-
-    @property
-    def state(self) -> DecoderState:
-        """Return the DecoderState, asserting all parts are present."""
-        h, c = self.get('h'), self.get('c')
-        assert h is not None, 'missing decoder h?'
-        assert c is not None, 'missing decoder c?'
-
-        h_lm, c_lm = self.get('h_lm'), self.get('c_lm')
-        assert (h_lm is None) == (c_lm is None), 'c_lm/h_lm set, but not both?'
-        if h_lm is not None and c_lm is not None:
-            h_lm = h_lm.permute(1, 0, 2).contiguous()
-            c_lm = c_lm.permute(1, 0, 2).contiguous()
-
-        return DecoderState(h, c, h_lm, c_lm)
-
-
-class AllenNLPDecoderStep(NamedTuple):
-    """Wraps the output of a single decoder step for allennlp beam search.
-
-    Fields:
-        scores (torch.Tensor): Same as in DecoderState.
-        state (Dict[str, torch.Tensor]): Same as in DecoderState, except state
-            is a dictionary.
-
-    """
-
-    scores: torch.Tensor
-    state: Dict[str, torch.Tensor]
-
-
 Strategy = Union[torch.Tensor, str]
 
 STRATEGY_GREEDY = 'greedy'
@@ -462,26 +399,13 @@ class Decoder(serialize.SerializableModule):
                 idx_s = currents
                 scores[:] += outputs.predictions[idx_b, idx_s].view(batch_size)
 
-        # Otherwise, if we're doing beam search, defer to allennlp.
+        # Otherwise, we're doing beam search.
         else:
-            runner = beam_search.BeamSearch(self.indexer.stop_index,
-                                            max_steps=length,
-                                            beam_size=beam_size)
-
-            def step(tokens: torch.Tensor,
-                     state: Dict[str, torch.Tensor]) -> AllenNLPDecoderStep:
-                """Take a decoding step."""
-                assert isinstance(state, AllenNLPDecoderState)
-                outputs = self.step(state.features,
-                                    tokens,
-                                    state.state,
-                                    temperature=temperature)
-                return AllenNLPDecoderStep(
-                    outputs.predictions,
-                    AllenNLPDecoderState(state.features, outputs.state))
-
-            tokens, scores = runner.search(
-                currents, AllenNLPDecoderState(features, state), step)
+            tokens, scores = self.beam_search(features,
+                                              state,
+                                              length=length,
+                                              beam_size=beam_size,
+                                              temperature=temperature)
 
             beam_captions = tuple(
                 map(self.indexer.reconstruct, tokens.tolist()))
@@ -494,22 +418,9 @@ class Decoder(serialize.SerializableModule):
                 scores = scores[:, 0]
             else:
                 assert strategy == STRATEGY_RERANK
-                assert self.lm is not None
-
-                starts_lm = currents.new_full((batch_size, beam_size, 1),
-                                              self.lm.indexer.start_index)
-                inputs_lm = torch.cat([starts_lm, tokens], dim=-1)
-                inputs_lm = inputs_lm.view(batch_size * beam_size, -1)
-
-                scores_lm = self.lm(inputs_lm, reduce=True)
-                scores_lm = scores_lm.view(batch_size, beam_size)
-
-                scores = scores - temperature * scores_lm
-
-                idx_b = torch.arange(batch_size)
-                idx_s = scores.argmax(dim=-1)
-                tokens = tokens[idx_b, idx_s].view(batch_size, -1)
-                scores = scores[idx_b, idx_s].view(batch_size)
+                tokens, scores = self.rerank(tokens,
+                                             scores,
+                                             temperature=temperature)
 
         return DecoderOutput(
             captions=self.indexer.reconstruct(tokens.tolist()),
@@ -522,6 +433,77 @@ class Decoder(serialize.SerializableModule):
             beam_tokens=beam_tokens,
         )
 
+    def score_lm(self, tokens: torch.Tensor) -> torch.Tensor:
+        """Compute the LM log probability of each hypothesis in a beam.
+
+        Args:
+            tokens (torch.Tensor): Shape (batch_size, beam_size, length)
+                integer tensor containing the hypotheses, as returned by
+                `Decoder.beam_search`.
+
+        Raises:
+            ValueError: If the decoder has no LM.
+
+        Returns:
+            torch.Tensor: Shape (batch_size, beam_size) tensor of LM log
+                probabilities.
+
+        """
+        if self.lm is None:
+            raise ValueError('cannot score hypotheses without an LM')
+        batch_size, beam_size, _ = tokens.shape
+
+        starts_lm = tokens.new_full((batch_size, beam_size, 1),
+                                    self.lm.indexer.start_index)
+        inputs_lm = torch.cat([starts_lm, tokens], dim=-1)
+        inputs_lm = inputs_lm.view(batch_size * beam_size, -1)
+
+        scores_lm = self.lm(inputs_lm, reduce=True)
+        return scores_lm.view(batch_size, beam_size)
+
+    def rerank(
+        self,
+        tokens: torch.Tensor,
+        scores: torch.Tensor,
+        temperature: Optional[float] = None,
+        scores_lm: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Pick the hypothesis in each beam that maximizes mutual info.
+
+        The LM scores do not depend on the temperature, so callers trying
+        several temperatures on the same beam can compute them once with
+        `Decoder.score_lm` and pass them in.
+
+        Args:
+            tokens (torch.Tensor): Shape (batch_size, beam_size, length)
+                integer tensor containing the hypotheses.
+            scores (torch.Tensor): Shape (batch_size, beam_size) tensor
+                containing the likelihood of each hypothesis.
+            temperature (Optional[float], optional): Weight of the LM score.
+                Defaults to `self.temperature`.
+            scores_lm (Optional[torch.Tensor], optional): Precomputed LM scores
+                for the hypotheses. By default, computed with the decoder LM.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Shape (batch_size, length)
+                integer tensor containing the best hypothesis for each sample,
+                and shape (batch_size,) tensor containing their scores.
+
+        """
+        if temperature is None:
+            temperature = self.temperature
+        if scores_lm is None:
+            scores_lm = self.score_lm(tokens)
+        batch_size = len(tokens)
+
+        scores = scores - temperature * scores_lm
+
+        idx_b = torch.arange(batch_size)
+        idx_s = scores.argmax(dim=-1)
+        tokens = tokens[idx_b, idx_s].view(batch_size, -1)
+        scores = scores[idx_b, idx_s].view(batch_size)
+        return tokens, scores
+
     def encode(self,
                images: torch.Tensor,
                masks: Optional[torch.Tensor] = None) -> torch.Tensor:
@@ -633,6 +615,128 @@ class Decoder(serialize.SerializableModule):
                            attentions=attentions,
                            state=DecoderState(h=h, c=c, h_lm=h_lm, c_lm=c_lm))
 
+    def beam_search(
+        self,
+        features: torch.Tensor,
+        state: DecoderState,
+        length: Optional[int] = None,
+        beam_size: Optional[int] = None,
+        temperature: Optional[float] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Decode with beam search, batched over samples and hypotheses.
+
+        Hypotheses for every sample are stored in a few flat tensors, and each
+        step takes a single top-k over all (hypothesis, word) pairs. Once every
+        hypothesis in a sample's beam has emitted the stop token, the sample
+        is dropped from the batch, so later steps only pay for samples that
+        are still decoding.
+
+        Args:
+            features (torch.Tensor): The visual features. Should have shape
+                (batch_size, n_features, feature_size).
+            state (DecoderState): The initial decoder state.
+            length (Optional[int], optional): Max number of decoding steps.
+                Defaults to `self.length`.
+            beam_size (Optional[int], optional): Beam size.
+                Defaults to `self.beam_size`.
+            temperature (Optional[float], optional): Temperature to use when MI
+                decoding. If not MI decoding, does nothing. Defaults to
+                `self.temperature`.
+
+        Raises:
+            ValueError: If beam size exceeds the vocab size.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Shape
+                (batch_size, beam_size, steps) integer tensor containing the
+                tokens of each hypothesis, padded with the stop token, and
+                shape (batch_size, beam_size) tensor containing their scores.
+                Hypotheses are sorted from best to worst.
+
+        """
+        if length is None:
+            length = self.length
+        if beam_size is None:
+            beam_size = self.beam_size
+        batch_size = len(features)
+        stop_index = self.indexer.stop_index
+
+        # Take the first step for every sample and seed the beams.
+        currents = features.new_empty(batch_size, dtype=torch.long)
+        currents.fill_(self.indexer.start_index)
+        outputs = self.step(features, currents, state, temperature=temperature)
+
+        vocab_size = outputs.predictions.shape[-1]
+        if beam_size > vocab_size:
+            raise ValueError(f'beam_size={beam_size} exceeds '
+                             f'vocab size {vocab_size}')
+
+        scores, currents = outputs.predictions.topk(beam_size, dim=-1)
+        tokens = currents.new_full((batch_size, beam_size, length), stop_index)
+        tokens[:, :, 0] = currents
+
+        # From here on, every tensor holds one row per (active sample, beam).
+        h, c, h_lm, c_lm = outputs.state
+        h = h.repeat_interleave(beam_size, dim=0)
+        c = c.repeat_interleave(beam_size, dim=0)
+        if h_lm is not None and c_lm is not None:
+            h_lm = h_lm.repeat_interleave(beam_size, dim=1)
+            c_lm = c_lm.repeat_interleave(beam_size, dim=1)
+        features = features.repeat_interleave(beam_size, dim=0)
+
+        # Finished hypotheses may only be extended with the stop token,
+        # which leaves their score unchanged.
+        finished = features.new_full((1, vocab_size), float('-inf'))
+        finished[:, stop_index] = 0
+
+        active = torch.arange(batch_size, device=tokens.device)
+        steps = 1
+        for time in range(1, length):
+            lasts = tokens[active, :, time - 1]
+
+            # Drop samples whose entire beam has finished.
+            keep = ~lasts.eq(stop_index).all(dim=-1)
+            if not keep.any():
+                break
+            if not keep.all():
+                rows = keep.repeat_interleave(beam_size)
+                active, lasts = active[keep], lasts[keep]
+                h, c, features = h[rows], c[rows], features[rows]
+                if h_lm is not None and c_lm is not None:
+                    h_lm, c_lm = h_lm[:, rows], c_lm[:, rows]
+
+            outputs = self.step(features,
+                                lasts.view(-1),
+                                DecoderState(h, c, h_lm, c_lm),
+                                temperature=temperature)
+            predictions = torch.where(lasts.view(-1, 1).eq(stop_index),
+                                      finished, outputs.predictions)
+
+            n_active = len(active)
+            candidates = scores[active].view(-1, 1) + predictions
+            candidates = candidates.view(n_active, beam_size * vocab_size)
+            top_scores, top_indices = candidates.topk(beam_size, dim=-1)
+            parents = torch.div(top_indices, vocab_size, rounding_mode='floor')
+            words = top_indices % vocab_size
+
+            # Reorder the surviving hypotheses and their states.
+            history = tokens[active].gather(
+                1, parents.unsqueeze(-1).expand(-1, -1, length))
+            history[:, :, time] = words
+            tokens[active] = history
+            scores[active] = top_scores
+
+            offsets = torch.arange(n_active, device=parents.device)
+            rows = (parents + offsets.unsqueeze(-1) * beam_size).view(-1)
+            h, c, h_lm, c_lm = outputs.state
+            h, c = h[rows], c[rows]
+            if h_lm is not None and c_lm is not None:
+                h_lm, c_lm = h_lm[:, rows], c_lm[:, rows]
+
+            steps = time + 1
+
+        return tokens[:, :, :steps], scores
+
     def score(self,
               captions: StrSequence,
               images_or_features: torch.Tensor,
@@ -714,6 +818,7 @@ class Decoder(serialize.SerializableModule):
              dataset: data.Dataset,
              annotation_index: int = 4,
              predictions: Optional[StrSequence] = None,
+             references: Optional[Sequence[StrSequence]] = None,
              **kwargs: Any) -> sacrebleu.BLEUScore:
         """Compute BLEU score of this model on the given dataset.
 
@@ -728,6 +833,9 @@ class Decoder(serialize.SerializableModule):
             predictions (Optional[StrSequence], optional): Precomputed
                 predicted captions for all images in the dataset.
                 By default, computed from the dataset using `Decoder.predict`.
+            references (Optional[Sequence[StrSequence]], optional): Tokenized
+                references from `metrics.bleu_references`. By default,
+                computed from the dataset.
 
         Returns:
             sacrebleu.BLEUScore: Corpus BLEU score.
@@ -737,7 +845,8 @@ class Decoder(serialize.SerializableModule):
             predictions = self.predict(dataset, **kwargs)
         return metrics.bleu(dataset,
                             predictions,
-                            annotation_index=annotation_index)
+                            annotation_index=annotation_index,
+                            references=references)
 
     def rouge(self,
               dataset: data.Dataset,
@@ -775,6 +884,8 @@ class Decoder(serialize.SerializableModule):
                    predictions: Optional[StrSequence] = None,
                    device: Optional[Device] = None,
                    bert_scorer: Optional[bert_score.BERTScorer] = None,
+                   references: Optional[Sequence[StrSequence]] = None,
+                   compute_idf: bool = True,
                    **kwargs: Any) -> Mapping[str, float]:
         """Return average BERTScore P/R/F.
 
@@ -792,6 +903,11 @@ class Decoder(serialize.SerializableModule):
                 instantiated BERTScorer object. Defaults to None.
             device (Optional[Device], optional): Run BERT on this device.
                 Defaults to torch default.
+            references (Optional[Sequence[StrSequence]], optional): References
+                from `metrics.bert_score_references`. By default, computed
+                from the dataset.
+            compute_idf (bool, optional): If the scorer uses IDF weights,
+                compute them from the references. Defaults to True.
 
         Returns:
             Mapping[str, float]: Average BERTScore precision/recall/F1.
@@ -804,7 +920,9 @@ class Decoder(serialize.SerializableModule):
                                   annotation_index=annotation_index,
                                   batch_size=bert_scorer_batch_size,
                                   device=device,
-                                  bert_scorer=bert_scorer)
+                                  bert_scorer=bert_scorer,
+                                  references=references,
+                                  compute_idf=compute_idf)
 
     def predict(self,
                 dataset: data.Dataset,
@@ -843,6 +961,65 @@ class Decoder(serialize.SerializableModule):
         Returns:
             StrSequence: Captions for entire dataset.
 
+        """
+        outputs = self.predict_outputs(
+            dataset,
+            mask=mask,
+            image_index=image_index,
+            mask_index=mask_index,
+            batch_size=batch_size,
+            features=features,
+            num_workers=num_workers,
+            device=device,
+            display_progress_as=display_progress_as,
+            **kwargs)
+
+        captions = []
+        for output in outputs:
+            captions += output.captions
+        return tuple(captions)
+
+    def predict_outputs(
+            self,
+            dataset: data.Dataset,
+            mask: bool = True,
+            image_index: int = 2,
+            mask_index: int = 3,
+            batch_size: int = 16,
+            features: Optional[data.TensorDataset] = None,
+            num_workers: int = 0,
+            device: Optional[Device] = None,
+            display_progress_as: Optional[str] = 'predict captions',
+            **kwargs: Any) -> Sequence[DecoderOutput]:
+        """Feed entire dataset through the decoder, keeping all outputs.
+
+        Unlike `Decoder.predict`, this returns the full decoder outputs, e.g.
+        so a beam can be searched once and then reranked many times.
+
+        Keyword arguments are passed to forward.
+
+        Args:
+            dataset (data.Dataset): The dataset of images/masks.
+            mask (bool, optional): Use masks when computing features. Exact
+                behavior depends on the featurizer. Defaults to True.
+            image_index (int, optional): Index of images in dataset samples.
+                Defaults to 2 to be compatible with AnnotatedTopImagesDataset.
+            mask_index (int, optional): Index of masks in dataset samples.
+                Defaults to 3 to be compatible with AnnotatedTopImagesDataset.
+            batch_size (int, optional): Number of samples to process on at
+                once. Defaults to 16.
+            features (Optional[data.TensorDataset], optional): Precomputed
+                image features. Defaults to None.
+            num_workers (int, optional): Number of workers for loading data.
+                Defaults to 0.
+            device (Optional[Device], optional): Send model and data to this
+                device. Defaults to None.
+            display_progress_as (Optional[str], optional): Show a progress bar
+                with this key. Defaults to 'predict captions'.
+
+        Returns:
+            Sequence[DecoderOutput]: Decoder outputs for each batch.
+
         """
         if device is not None:
             self.to(device)
@@ -864,11 +1041,7 @@ class Decoder(serialize.SerializableModule):
                 output = self(*inputs, **kwargs)
             outputs.append(output)
 
-        captions = []
-        for output in outputs:
-            captions += output.captions
-
-        return tuple(captions)
+        return tuple(outputs)
 
     def fit(self,
             dataset: data.Dataset,
@@ -886,6 +1059,7 @@ class Decoder(serialize.SerializableModule):
             optimizer_kwargs: Optional[Mapping[str, Any]] = None,
             features: Optional[data.TensorDataset] = None,
             num_workers: int = 0,
+            pin_memory: bool = False,
             device: Optional[Device] = None,
             display_progress_as: Optional[str] = 'train decoder') -> None:
         """Train a new decoder on the given data.
@@ -923,6 +1097,9 @@ class Decoder(serialize.SerializableModule):
                 captioner.
             num_workers (int, optional): Number of workers for loading data.
                 Defaults to 0.
+            pin_memory (bool, optional): Load batches into pinned memory so
+                they copy to the device asynchronously. Useful when features
+                are kept on the CPU. Defaults to False.
             device (Optional[Device], optional): Send all models and data
                 to this device. Defaults to None.
             display_progress_as (Optional[str], optional): Show a progress bar
@@ -973,10 +1150,12 @@ class Decoder(serialize.SerializableModule):
 
         train_loader = data.DataLoader(WrapperDataset(train),
                                        num_workers=num_workers,
+                                       pin_memory=pin_memory,
                                        batch_size=batch_size,
                                        shuffle=True)
         val_loader = data.DataLoader(WrapperDataset(val),
                                      num_workers=num_workers,
+                                     pin_memory=pin_memory,
                                      batch_size=batch_size)
 
         # Prepare model and training tools.
@@ -998,17 +1177,19 @@ class Decoder(serialize.SerializableModule):
 
                 with torch.no_grad():
                     inputs = self.encode(
-                        images.to(device),
-                        masks=masks.to(device) if masks is not None else None)
+                        images.to(device, non_blocking=pin_memory),
+                        masks=masks.to(device, non_blocking=pin_memory)
+                        if masks is not None else None)
             else:
                 inputs, = cast(torch.Tensor, images_or_features)
                 assert inputs is not None
+                inputs = inputs.to(device, non_blocking=pin_memory)
 
             targets = torch.tensor(self.indexer(captions), device=device)
             targets = targets[:, 1:]
             _, length = targets.shape
 
-            outputs: DecoderOutput = self(inputs.to(device),
+            outputs: DecoderOutput = self(inputs,
                                           length=length,
                                           strategy=targets,
                                           mi=False)
@@ -240,6 +240,15 @@ PyramidConvEncoderConfig = Tuple[ClassifierFactory, ClassifierLayers,
                                  ClassifierFeatureSize]
 
 
+class StopForward(Exception):
+    """Raised to end a forward pass once all needed features are recorded."""
+
+
+def stop_forward(x: torch.Tensor) -> torch.Tensor:
+    """Edit rule that ends the forward pass after the layer it edits."""
+    raise StopForward
+
+
 class PyramidConvEncoder(Encoder, serialize.SerializableModule):
     """Encode images at multiple resolutions into a single vector.
 
@@ -275,6 +284,10 @@ class PyramidConvEncoder(Encoder, serialize.SerializableModule):
         self.encoder.retain_layers(layers)
         self.encoder.eval()
 
+        # Nothing after the last retained layer affects the features, so stop
+        # the forward pass there instead of running, e.g., the classifier head.
+        self.encoder.edit_layer(layers[-1], rule=stop_forward)
+
         self.layers = layers
         self.feature_shape = (feature_size,)
 
@@ -295,7 +308,10 @@ class PyramidConvEncoder(Encoder, serialize.SerializableModule):
             images = (images - self.mean) / self.std
 
         # Feed images to encoder, letting nethook record layer activations.
-        self.encoder(images)
+        try:
+            self.encoder(images)
+        except StopForward:
+            pass
         features = self.encoder.retained_features(clear=True).values()
 
         # Mask the features at each level of the pyramid.
@@ -205,7 +205,8 @@ class TopImagesDataset(data.Dataset):
             self.units_by_layer[layer] = units
 
         self.samples = []
-        for layer in layers:
+        layer_ids, unit_ids = [], []
+        for layer_id, layer in enumerate(layers):
             for unit, images, masks in zip(self.units_by_layer[layer],
                                            self.images_by_layer[layer],
                                            self.masks_by_layer[layer]):
@@ -218,6 +219,13 @@ class TopImagesDataset(data.Dataset):
                                    images=images,
                                    masks=masks)
                 self.samples.append(sample)
+                layer_ids.append(layer_id)
+                unit_ids.append(sample.unit)
+
+        # Also store each sample's layer (as an index into self.layers) and
+        # unit number in flat arrays, so many units can be looked up at once.
+        self.layer_ids = numpy.array(layer_ids, dtype=int)
+        self.unit_ids = numpy.array(unit_ids, dtype=int)
 
     def __getitem__(self, index: int) -> TopImages:
         """Return the top images.
@@ -269,8 +277,8 @@ class TopImagesDataset(data.Dataset):
             Unit: Layer and unit number.
 
         """
-        sample = self[index]
-        return sample.layer, sample.unit
+        layer_id, unit_id = self.layer_ids[index], self.unit_ids[index]
+        return self.layers[int(layer_id)], int(unit_id)
 
     def units(self, indices: Sequence[int]) -> Sequence[Unit]:
         """Return the units at the given indices.
@@ -282,8 +290,9 @@ class TopImagesDataset(data.Dataset):
             Sequence[Unit]: Layer and unit numbers.
 
         """
-        units = [self.unit(index) for index in indices]
-        return tuple(units)
+        positions = numpy.asarray(indices, dtype=int)
+        layers = [self.layers[i] for i in self.layer_ids[positions].tolist()]
+        return tuple(zip(layers, self.unit_ids[positions].tolist()))
 
     @property
     def k(self) -> int:
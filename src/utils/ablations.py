@@ -1,8 +1,8 @@
 """Utilities for altering unit activations real-time."""
 import collections
 import contextlib
-from typing import (Any, Callable, Dict, Iterator, Mapping, Optional, Sequence,
-                    Sized, Type, Union, cast)
+from typing import (Any, Callable, Dict, Iterator, List, Mapping, Optional,
+                    Sequence, Sized, Type, Union, cast)
 
 from src.deps.netdissect import nethook
 from src.utils import training
@@ -42,6 +42,75 @@ def zero(units: Sequence[int]) -> Callable[[torch.Tensor], torch.Tensor]:
     return fn
 
 
+def zero_each(units: Sequence[Sequence[int]],
+              tile: bool = False) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Zero a different set of units in each copy of the batch.
+
+    Layer features are treated as `len(units)` copies of the same batch,
+    stacked along the batch dimension, and the i-th copy has `units[i]` zeroed.
+
+    Args:
+        units (Sequence[Sequence[int]]): The units to zero in each copy.
+        tile (bool, optional): If set, the incoming features are a single
+            batch and are first tiled once per copy. Defaults to False.
+
+    Returns:
+        Callable[[torch.Tensor], torch.Tensor]: Function that takes layer
+            features and zeros the given units in each copy, returning the
+            result.
+
+    """
+    copies = [copy for copy, uns in enumerate(units) for _ in uns]
+    zeroed = [un for uns in units for un in uns]
+
+    def fn(features: torch.Tensor) -> torch.Tensor:
+        if features.dim() != 4:
+            raise ValueError(f'expected 4D features, got {features.dim()}')
+        if tile:
+            features = features.repeat(len(units), 1, 1, 1)
+        shape = features.shape
+        mask = features.new_ones(len(units), 1, shape[1], 1, 1)
+        mask[copies, 0, zeroed] = 0
+        features = features.reshape(len(units), -1, *shape[1:]) * mask
+        return features.view(*shape)
+
+    return fn
+
+
+def parallel_rules(model: nn.Module,
+                   ablations: Sequence[Sequence[Unit]]) -> Mapping[str, Rule]:
+    """Return edit rules that apply each ablation to its own copy of a batch.
+
+    The batch is tiled once per ablation at the earliest ablated layer, so
+    the model outputs `len(ablations)` stacked copies of its usual output,
+    with the i-th copy computed under `ablations[i]`. Layers are ordered by
+    `model.named_modules()`, which must match the order in which they run.
+
+    Args:
+        model (nn.Module): The model to ablate.
+        ablations (Sequence[Sequence[Unit]]): The (layer, unit) pairs to
+            ablate in each copy.
+
+    Returns:
+        Mapping[str, Rule]: Mapping from layer name to its edit rule. Empty
+            if no ablation has any units.
+
+    """
+    edits: Dict[str, List[List[int]]] = {}
+    for index, units in enumerate(ablations):
+        for la, un in units:
+            layer = str(la)
+            if layer not in edits:
+                edits[layer] = [[] for _ in ablations]
+            edits[layer][index].append(un)
+
+    rules = {}
+    for name, _ in model.named_modules():
+        if name in edits:
+            rules[name] = zero_each(edits[name], tile=not rules)
+    return rules
+
+
 @contextlib.contextmanager
 def ablated(
     model: nn.Module,
@@ -98,6 +167,7 @@ class ImageClassifier(nn.Module):
             optimizer_t: Type[optim.Optimizer] = optim.AdamW,
             optimizer_kwargs: Optional[Mapping[str, Any]] = None,
             num_workers: int = 0,
+            pin_memory: bool = False,
             ablate: Optional[Sequence[Unit]] = None,
             layers: Optional[Sequence[Layer]] = None,
             device: Optional[Device] = None,
@@ -125,7 +195,10 @@ class ImageClassifier(nn.Module):
             optimizer_kwargs (Optional[Mapping[str, Any]], optional): Optimizer
                 options. Defaults to None.
             num_workers (int, optional): Number of worker threads to use in the
-                `torch.utils.data.DataLoader`. Defaults to 0.
+                `torch.utils.data.DataLoader`. Workers persist across epochs.
+                Defaults to 0.
+            pin_memory (bool, optional): Load batches into pinned memory so
+                they copy to the GPU asynchronously. Defaults to False.
             ablate (Optional[Sequence[Unit]], optional): Ablate these neurons
                 when training. Defaults to None.
             layers (Optional[Sequence[Layer]], optional) Layers to optimize.
@@ -148,10 +221,14 @@ class ImageClassifier(nn.Module):
         train_loader = data.DataLoader(train,
                                        batch_size=batch_size,
                                        num_workers=num_workers,
+                                       pin_memory=pin_memory,
+                                       persistent_workers=num_workers > 0,
                                        shuffle=True)
         val_loader = data.DataLoader(val,
                                      batch_size=batch_size,
-                                     num_workers=num_workers)
+                                     num_workers=num_workers,
+                                     pin_memory=pin_memory,
+                                     persistent_workers=num_workers > 0)
 
         if layers is None:
             parameters = list(self.parameters())
@@ -181,8 +258,10 @@ class ImageClassifier(nn.Module):
                 model.train()
                 train_loss = 0.
                 for batch in train_loader:
-                    images = batch[image_index].to(device)
-                    targets = batch[target_index].to(device)
+                    images = batch[image_index].to(device,
+                                                   non_blocking=pin_memory)
+                    targets = batch[target_index].to(device,
+                                                     non_blocking=pin_memory)
                     predictions = model(images)
                     loss = criterion(predictions, targets)
                     loss.backward()
@@ -194,8 +273,10 @@ class ImageClassifier(nn.Module):
                 model.eval()
                 val_loss = 0.
                 for batch in val_loader:
-                    images = batch[image_index].to(device)
-                    targets = batch[target_index].to(device)
+                    images = batch[image_index].to(device,
+                                                   non_blocking=pin_memory)
+                    targets = batch[target_index].to(device,
+                                                     non_blocking=pin_memory)
                     with torch.no_grad():
                         predictions = model(images)
                         loss = criterion(predictions, targets)
@@ -221,6 +302,7 @@ class ImageClassifier(nn.Module):
         image_index: int = 0,
         batch_size: int = 128,
         num_workers: int = 0,
+        pin_memory: bool = False,
         ablate: Optional[Sequence[Unit]] = None,
         device: Optional[Device] = None,
         display_progress_as: Optional[str] = 'classify images',
@@ -236,6 +318,8 @@ class ImageClassifier(nn.Module):
                 Defaults to 128.
             num_workers (int, optional): Number of workers for DataLoader
                 to use. Defaults to 0.
+            pin_memory (bool, optional): Load batches into pinned memory so
+                they copy to the GPU asynchronously. Defaults to False.
             ablate (Optional[Sequence[Unit]], optional): Ablate these units
                 before testing. Defaults to None.
             device (Optional[Device], optional): Send this model and all
@@ -254,6 +338,7 @@ class ImageClassifier(nn.Module):
         # Prepare data loader.
         loader = data.DataLoader(dataset,
                                  num_workers=num_workers,
+                                 pin_memory=pin_memory,
                                  batch_size=batch_size)
         if display_progress_as is not None:
             loader = tqdm(loader, desc=display_progress_as)
@@ -262,12 +347,126 @@ class ImageClassifier(nn.Module):
         predictions = []
         with ablated(self.model, ablate or []) as model:
             for batch in loader:
-                images = batch[image_index].to(device)
+                images = batch[image_index].to(device, non_blocking=pin_memory)
                 with torch.no_grad():
                     predictions.append(model(images).argmax(dim=-1))
 
         return torch.cat(predictions)
 
+    def predict_ablations(
+        self,
+        dataset: data.Dataset,
+        ablations: Sequence[Sequence[Unit]],
+        image_index: int = 0,
+        batch_size: int = 128,
+        ablations_per_batch: int = 16,
+        num_workers: int = 0,
+        pin_memory: bool = False,
+        device: Optional[Device] = None,
+        display_progress_as: Optional[str] = 'classify images (ablated)',
+    ) -> torch.Tensor:
+        """Run the model on every element in the dataset, once per ablation.
+
+        This is equivalent to calling `predict` once for each ablation, but
+        reads the dataset only once and evaluates up to `ablations_per_batch`
+        ablations in a single forward pass over each batch. Setting it to 1
+        trades speed for the memory footprint of `predict`. If a forward pass
+        runs out of GPU memory, the number of ablations per pass is halved
+        (down to 1) and the batch is retried.
+
+        Args:
+            dataset (data.Dataset): The dataset.
+            ablations (Sequence[Sequence[Unit]]): The units to ablate in each
+                run of the model.
+            image_index (int, optional): Index of images in dataset.
+                Defaults to 0 to be compatible with
+                `torchvision.datasets.ImageFolder`.
+            batch_size (int, optional): Number of samples to process at once.
+                Defaults to 128.
+            ablations_per_batch (int, optional): Number of ablations to apply
+                in each forward pass. Defaults to 16.
+            num_workers (int, optional): Number of workers for DataLoader
+                to use. Defaults to 0.
+            pin_memory (bool, optional): Load batches into pinned memory so
+                they copy to the GPU asynchronously. Defaults to False.
+            device (Optional[Device], optional): Send this model and all
+                tensors to this device. Defaults to None.
+            display_progress_as (Optional[str], optional): Show a progress bar
+                with this message while testing. Defaults to
+                'classify images (ablated)'.
+
+        Returns:
+            torch.Tensor: Long tensor containing class predictions for every
+                item in the dataset under every ablation, with shape
+                (len(ablations), len(dataset)).
+
+        """
+        if ablations_per_batch < 1:
+            raise ValueError('ablations_per_batch must be >= 1, '
+                             f'got {ablations_per_batch}')
+        if device is not None:
+            self.to(device)
+        if not ablations:
+            return torch.empty(0,
+                               len(cast(Sized, dataset)),
+                               dtype=torch.long,
+                               device=device)
+
+        # Prepare data loader.
+        loader = data.DataLoader(dataset,
+                                 num_workers=num_workers,
+                                 pin_memory=pin_memory,
+                                 batch_size=batch_size)
+        if display_progress_as is not None:
+            loader = tqdm(loader, desc=display_progress_as)
+
+        # Rules for each chunk of ablations, keyed by chunk size.
+        rules: Dict[int, List[Mapping[str, Rule]]] = {}
+
+        def predict_batch(model: nethook.InstrumentedModel,
+                          images: torch.Tensor, size: int) -> torch.Tensor:
+            """Predict the batch under every ablation, `size` at a time."""
+            starts = range(0, len(ablations), size)
+            if size not in rules:
+                rules[size] = [
+                    parallel_rules(self.model, ablations[start:start + size])
+                    for start in starts
+                ]
+
+            outputs = []
+            for start, chunk_rules in zip(starts, rules[size]):
+                chunk = ablations[start:start + size]
+                model.remove_edits()
+                for layer, rule in chunk_rules.items():
+                    model.edit_layer(layer, rule=rule)
+                with torch.no_grad():
+                    chunk_outputs = model(images).argmax(dim=-1)
+                if not chunk_rules:
+                    chunk_outputs = chunk_outputs.repeat(len(chunk))
+                outputs.append(chunk_outputs.view(len(chunk), -1))
+            return torch.cat(outputs)
+
+        # Compute predictions, swapping in each chunk's rules for every batch.
+        predictions = []
+        with nethook.InstrumentedModel(self.model) as model:
+            for batch in loader:
+                images = batch[image_index].to(device, non_blocking=pin_memory)
+                while True:
+                    try:
+                        outputs = predict_batch(model, images,
+                                                ablations_per_batch)
+                    except RuntimeError as error:
+                        if ('out of memory' not in str(error) or
+                                ablations_per_batch == 1):
+                            raise
+                        ablations_per_batch //= 2
+                        torch.cuda.empty_cache()
+                    else:
+                        break
+                predictions.append(outputs)
+
+        return torch.cat(predictions, dim=-1)
+
     def accuracy(
         self,
         dataset: data.Dataset,
@@ -311,6 +510,51 @@ class ImageClassifier(nn.Module):
         correct = predictions.eq(targets).sum().item()
         return correct / size
 
+    def accuracy_ablations(
+        self,
+        dataset: data.Dataset,
+        ablations: Sequence[Sequence[Unit]],
+        target_index: int = 1,
+        device: Optional[Device] = None,
+        display_progress_as: Optional[str] = 'test classifier (ablated)',
+        **kwargs: Any,
+    ) -> Sequence[float]:
+        """Compute accuracy of this model on the dataset under each ablation.
+
+        The **kwargs are forwarded to `ImageClassifier.predict_ablations`.
+
+        Args:
+            dataset (data.Dataset): The dataset.
+            ablations (Sequence[Sequence[Unit]]): The units to ablate in each
+                run of the model.
+            target_index (int, optional): Index of target labels in dataset.
+                Defaults to 1 to be compatible with
+                `torchvision.datasets.ImageFolder`.
+            device (Optional[Device], optional): Send this model and all
+                tensors to this device. Defaults to None.
+            display_progress_as (Optional[str], optional): Show a progress bar
+                with this message while testing. Defaults to
+                'test classifier (ablated)'.
+
+        Returns:
+            Sequence[float]: Accuracy on the dataset under each ablation.
+
+        """
+        predictions = self.predict_ablations(
+            dataset,
+            ablations,
+            device=device,
+            display_progress_as=display_progress_as,
+            **kwargs)
+        size = len(cast(Sized, dataset))
+        targets = torch.tensor(
+            [dataset[index][target_index] for index in range(size)],
+            dtype=torch.long,
+            device=device,
+        )
+        corrects = predictions.eq(targets).sum(dim=-1).tolist()
+        return [correct / size for correct in corrects]
+
     def accuracies(
         self,
         dataset: data.Dataset,
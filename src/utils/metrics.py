@@ -1,21 +1,66 @@
 """Utilities for computing standard performance metrics."""
 import warnings
-from typing import Mapping, Optional
+from typing import Callable, Mapping, Optional, Sequence, Sized, cast
 
 from src.deps.ext import bert_score as bert_score_lib
 from src.utils.typing import Device, StrSequence
 
 import rouge as rouge_lib
 import sacrebleu
+from sacrebleu.tokenizers import tokenizer_13a
 from torch.utils import data
 
 # TODO(evandez): Move accuracy fns here?
 # TODO(evandez): Commonize string normalization.
 
+BLEU_TOKENIZER = tokenizer_13a.Tokenizer13a()
 
-def bleu(dataset: data.Dataset,
-         predictions: StrSequence,
-         annotation_index: int = 4) -> sacrebleu.BLEUScore:
+
+def bleu_tokenize(text: str) -> str:
+    """Normalize text and tokenize it as `sacrebleu.corpus_bleu` would."""
+    return BLEU_TOKENIZER(text.lower().strip('. ').rstrip())
+
+
+def _references(dataset: data.Dataset, annotation_index: int,
+                preprocess: Callable[[str], str]) -> Sequence[StrSequence]:
+    """Read and preprocess the reference annotations for every sample."""
+    references = []
+    for index in range(len(cast(Sized, dataset))):
+        annotations = dataset[index][annotation_index]
+        if isinstance(annotations, str):
+            annotations = [annotations]
+        # Preprocess target annotations in the same way as the predictions.
+        references.append([preprocess(anno) for anno in annotations])
+    return tuple(references)
+
+
+def bleu_references(dataset: data.Dataset,
+                    annotation_index: int = 4) -> Sequence[StrSequence]:
+    """Preprocess and tokenize the BLEU references for every dataset sample.
+
+    Tokenizing references is the bulk of the work in computing BLEU, so
+    callers that score many predictions against the same dataset should
+    compute the references once and pass them to `bleu`.
+
+    Args:
+        dataset (data.Dataset): The test dataset.
+        annotation_index (int, optional): Index of language annotations in
+            dataset samples. Defaults to 4 to be compatible with
+            AnnotatedTopImagesDataset.
+
+    Returns:
+        Sequence[StrSequence]: Tokenized references for each sample.
+
+    """
+    return _references(dataset, annotation_index, bleu_tokenize)
+
+
+def bleu(
+    dataset: data.Dataset,
+    predictions: StrSequence,
+    annotation_index: int = 4,
+    references: Optional[Sequence[StrSequence]] = None,
+) -> sacrebleu.BLEUScore:
     """Compute BLEU score of this model on the given dataset.
 
     Keyword arguments forwarded to `Decoder.predict` if `predictions` not
@@ -27,23 +72,26 @@ def bleu(dataset: data.Dataset,
         annotation_index (int, optional): Index of language annotations in
             dataset samples. Defaults to 4 to be compatible with
             AnnotatedTopImagesDataset.
+        references (Optional[Sequence[StrSequence]], optional): Precomputed
+            references from `bleu_references`. By default, computed from
+            the dataset.
 
     Returns:
         sacrebleu.BLEUScore: Corpus BLEU score.
 
     """
-    predictions = [pred.lower().strip('. ') for pred in predictions]
+    if references is None:
+        references = bleu_references(dataset,
+                                     annotation_index=annotation_index)
+    references = references[:len(predictions)]
 
-    references = []
-    for index in range(len(predictions)):
-        annotations = dataset[index][annotation_index]
-        if isinstance(annotations, str):
-            annotations = [annotations]
-        # Preprocess target annotations in the same way as the predictions.
-        annotations = [anno.lower().strip('. ') for anno in annotations]
-        references.append(annotations)
+    predictions = [bleu_tokenize(pred) for pred in predictions]
 
-    return sacrebleu.corpus_bleu(predictions, list(zip(*references)))
+    # Everything is already tokenized exactly as sacrebleu would, so tell it
+    # not to tokenize again.
+    return sacrebleu.corpus_bleu(predictions,
+                                 list(zip(*references)),
+                                 tokenize='none')
 
 
 def rouge(dataset: data.Dataset,
@@ -91,6 +139,24 @@ def rouge(dataset: data.Dataset,
                              ignore_empty=True)
 
 
+def bert_score_references(dataset: data.Dataset,
+                          annotation_index: int = 4) -> Sequence[StrSequence]:
+    """Preprocess the BERTScore references for every dataset sample.
+
+    Args:
+        dataset (data.Dataset): The test dataset.
+        annotation_index (int, optional): Index of language annotations in
+            dataset samples. Defaults to 4 to be compatible with
+            AnnotatedTopImagesDataset.
+
+    Returns:
+        Sequence[StrSequence]: References for each sample.
+
+    """
+    return _references(dataset, annotation_index,
+                       lambda anno: anno.lower().strip('. '))
+
+
 def bert_score(
     dataset: data.Dataset,
     predictions: StrSequence,
@@ -98,6 +164,8 @@ def bert_score(
     batch_size: int = 16,
     device: Optional[Device] = None,
     bert_scorer: Optional[bert_score_lib.BERTScorer] = None,
+    references: Optional[Sequence[StrSequence]] = None,
+    compute_idf: bool = True,
 ) -> Mapping[str, float]:
     """Return average BERTScore P/R/F.
 
@@ -116,6 +184,13 @@ def bert_score(
             pre-instantiated BERTScorer object. Defaults to None.
         device (Optional[Device], optional): Run BERT on this device.
             Defaults to torch default.
+        references (Optional[Sequence[StrSequence]], optional): Precomputed
+            references from `bert_score_references`. By default, computed
+            from the dataset.
+        compute_idf (bool, optional): If the scorer uses IDF weights, compute
+            them from the references. Set to False if the scorer's IDF
+            weights were already computed from these references.
+            Defaults to True.
 
     Returns:
         Mapping[str, float]: Average BERTScore precision/recall/F1.
@@ -128,18 +203,14 @@ def bert_score(
                                                 use_fast_tokenizer=True,
                                                 device=device)
 
-    predictions = [pred.lower().strip('. ') for pred in predictions]
+    if references is None:
+        references = bert_score_references(dataset,
+                                           annotation_index=annotation_index)
+    references = references[:len(predictions)]
 
-    references = []
-    for index in range(len(predictions)):
-        annotations = dataset[index][annotation_index]
-        if isinstance(annotations, str):
-            annotations = [annotations]
-        # Preprocess target annotations in the same way as the predictions.
-        annotations = [anno.lower().strip('. ') for anno in annotations]
-        references.append(annotations)
+    predictions = [pred.lower().strip('. ') for pred in predictions]
 
-    if bert_scorer.idf:
+    if bert_scorer.idf and compute_idf:
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore', message=r'.*Overwriting.*')
             bert_scorer.compute_idf([r for rs in references for r in rs])
@@ -4,6 +4,7 @@ from typing import Any, Sequence, Sized, Tuple, cast
 
 from src.utils.typing import PathLike
 
+import numpy
 from torch.utils import data
 from torchvision import datasets
 from tqdm import tqdm
@@ -54,6 +55,30 @@ class EarlyStopping:
         return self.num_bad == 0
 
 
+def step_grid(start: float, stop: float, step: float) -> Sequence[float]:
+    """Return the grid `start, start + step, ...` up to but excluding `stop`.
+
+    Unlike `numpy.arange` with a float step, rounding error never adds or
+    drops a point, and every point is a whole number of steps from `start`.
+
+    Args:
+        start (float): First point in the grid.
+        stop (float): Upper bound on the grid, exclusive.
+        step (float): Distance between consecutive points.
+
+    Raises:
+        ValueError: If the step is not positive.
+
+    Returns:
+        Sequence[float]: The grid points.
+
+    """
+    if step <= 0:
+        raise ValueError(f'step must be positive, got {step}')
+    size = max(int(numpy.ceil((stop - start) / step - 1e-9)), 0)
+    return (start + step * numpy.arange(size)).tolist()
+
+
 def random_split(dataset: data.Dataset,
                  hold_out: float = .1) -> Tuple[data.Subset, data.Subset]:
     """Randomly split the dataset into a train and val set.
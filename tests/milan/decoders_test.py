@@ -0,0 +1,189 @@
+"""Unit tests for `src.milan.decoders` module."""
+from typing import Dict, Optional
+
+from src.milan import decoders, lms
+from src.utils import lang
+
+import pytest
+import torch
+from allennlp.nn import beam_search
+from torch.utils import data
+
+TEXTS = (
+    'a dog with a red ball',
+    'the blue sky over green grass',
+    'text written on a white sign',
+    'wheels of a car on the road',
+)
+
+BATCH_SIZE = 6
+N_FEATURES = 4
+LENGTH = 8
+BEAM_SIZE = 3
+TEMPERATURE = .3
+TEMPERATURES = (.1, .5)
+
+
+class EarlyStopDecoder(decoders.Decoder):
+    """A Decoder that strongly prefers stopping for some samples.
+
+    Samples whose first feature is negative get a large bonus on the stop
+    token at every step, so their beams finish long before the others.
+    """
+
+    def step(self,
+             features: torch.Tensor,
+             tokens: torch.Tensor,
+             state: decoders.DecoderState,
+             temperature: Optional[float] = None) -> decoders.DecoderStep:
+        """Take a step, then boost the stop token for early samples."""
+        outputs = super().step(features,
+                               tokens,
+                               state,
+                               temperature=temperature)
+        predictions = outputs.predictions.clone()
+        early = features[:, 0, 0].lt(0)
+        predictions[early, self.indexer.stop_index] += 10
+        return outputs._replace(predictions=predictions)
+
+
+@pytest.fixture
+def indexer():
+    """Return an indexer over a tiny vocabulary for testing."""
+    return lang.indexer(TEXTS, start=True, stop=True, pad=True, unk=True)
+
+
+@pytest.fixture
+def features(encoder):
+    """Return random visual features for testing."""
+    feature_size = encoder.feature_shape[-1]
+    return torch.rand(BATCH_SIZE, N_FEATURES, feature_size)
+
+
+def new_decoder(indexer, encoder, mi):
+    """Return a small, randomly initialized decoder for testing."""
+    lm = None
+    if mi:
+        lm = lms.LanguageModel(indexer,
+                               embedding_size=8,
+                               hidden_size=16,
+                               layers=2)
+    return EarlyStopDecoder(indexer,
+                            encoder,
+                            lm=lm,
+                            embedding_size=8,
+                            hidden_size=16).eval()
+
+
+def allennlp_beam_search(decoder, features, state):
+    """Run allennlp's beam search, which `Decoder.beam_search` replaced."""
+
+    def pack(features: torch.Tensor,
+             state: decoders.DecoderState) -> Dict[str, torch.Tensor]:
+        packed = {'features': features, 'h': state.h, 'c': state.c}
+        if state.h_lm is not None and state.c_lm is not None:
+            packed['h_lm'] = state.h_lm.permute(1, 0, 2).contiguous()
+            packed['c_lm'] = state.c_lm.permute(1, 0, 2).contiguous()
+        return packed
+
+    def step(tokens, packed):
+        h_lm, c_lm = packed.get('h_lm'), packed.get('c_lm')
+        if h_lm is not None and c_lm is not None:
+            h_lm = h_lm.permute(1, 0, 2).contiguous()
+            c_lm = c_lm.permute(1, 0, 2).contiguous()
+        state = decoders.DecoderState(packed['h'], packed['c'], h_lm, c_lm)
+        outputs = decoder.step(packed['features'],
+                               tokens,
+                               state,
+                               temperature=TEMPERATURE)
+        return outputs.predictions, pack(packed['features'], outputs.state)
+
+    runner = beam_search.BeamSearch(decoder.indexer.stop_index,
+                                    max_steps=LENGTH,
+                                    beam_size=BEAM_SIZE)
+    starts = torch.full((len(features),),
+                        decoder.indexer.start_index,
+                        dtype=torch.long)
+    return runner.search(starts, pack(features, state), step)
+
+
+@pytest.mark.parametrize('mi', (False, True))
+@pytest.mark.parametrize('n_early', (0, BATCH_SIZE // 2, BATCH_SIZE))
+def test_decoder_beam_search(indexer, encoder, features, mi, n_early):
+    """Test Decoder.beam_search matches allennlp's beam search."""
+    features[:n_early, 0, 0] = -1
+    model = new_decoder(indexer, encoder, mi)
+    with torch.no_grad():
+        state = model.init_state(features, lm=mi)
+        actual_tokens, actual_scores = model.beam_search(
+            features,
+            state,
+            length=LENGTH,
+            beam_size=BEAM_SIZE,
+            temperature=TEMPERATURE)
+        expected_tokens, expected_scores = allennlp_beam_search(
+            model, features, state)
+
+    assert actual_tokens.shape == expected_tokens.shape
+    assert actual_tokens.equal(expected_tokens)
+    assert actual_scores.allclose(expected_scores, atol=1e-5)
+
+    # When every sample stops early, the output is truncated.
+    if n_early == BATCH_SIZE:
+        assert actual_tokens.shape[-1] < LENGTH
+
+
+def test_decoder_beam_search_bad_beam_size(indexer, encoder, features):
+    """Test Decoder.beam_search dies when beam is larger than vocab."""
+    model = new_decoder(indexer, encoder, False)
+    beam_size = model.vocab_size + 1
+    with pytest.raises(ValueError, match=f'.*beam_size={beam_size}.*'):
+        model.beam_search(features,
+                          model.init_state(features, lm=False),
+                          beam_size=beam_size)
+
+
+def test_decoder_rerank_reuses_beam(indexer, encoder, features):
+    """Test reranking one beam at several temperatures matches forward."""
+    model = new_decoder(indexer, encoder, True)
+    with torch.no_grad():
+        beam = model(features,
+                     length=LENGTH,
+                     strategy='beam',
+                     mi=False,
+                     beam_size=BEAM_SIZE)
+        assert beam.beam_tokens is not None
+        assert beam.beam_scores is not None
+        scores_lm = model.score_lm(beam.beam_tokens)
+        for temperature in TEMPERATURES:
+            actual_tokens, actual_scores = model.rerank(
+                beam.beam_tokens,
+                beam.beam_scores,
+                temperature=temperature,
+                scores_lm=scores_lm)
+            expected = model(features,
+                             length=LENGTH,
+                             strategy='rerank',
+                             temperature=temperature,
+                             beam_size=BEAM_SIZE)
+            assert actual_tokens.equal(expected.tokens)
+            assert actual_scores.allclose(expected.scores, atol=1e-5)
+
+
+def test_decoder_predict(indexer, encoder, features):
+    """Test Decoder.predict concatenates Decoder.predict_outputs captions."""
+    model = new_decoder(indexer, encoder, False)
+    dataset = data.TensorDataset(features)
+    kwargs = dict(features=dataset,
+                  batch_size=BATCH_SIZE // 2,
+                  display_progress_as=None,
+                  length=LENGTH,
+                  strategy='beam',
+                  beam_size=BEAM_SIZE)
+    outputs = model.predict_outputs(dataset, **kwargs)
+    assert len(outputs) == 2
+
+    expected = tuple(
+        caption for output in outputs for caption in output.captions)
+    actual = model.predict(dataset, **kwargs)
+    assert actual == expected
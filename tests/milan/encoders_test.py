@@ -75,3 +75,17 @@ def test_pyramid_conv_encoder_forward_all_invalid_masks(config, images, masks):
     actual = encoder(images, torch.zeros_like(masks))
     assert actual.shape == (BATCH_SIZE, *encoder.feature_shape)
     assert actual.eq(0).all()
+
+
+@pytest.mark.parametrize('config,head', (
+    ('resnet18', 'fc'),
+    ('alexnet', 'classifier'),
+))
+def test_pyramid_conv_encoder_forward_skips_head(config, head, images, masks):
+    """Test PyramidConvEncoder.forward does not run the classifier head."""
+    encoder = encoders.PyramidConvEncoder(config=config, pretrained=False)
+    calls = []
+    module = dict(encoder.encoder.model.named_modules())[head]
+    module.register_forward_hook(lambda *_: calls.append(head))
+    encoder(images, masks)
+    assert not calls
@@ -241,6 +241,21 @@ def test_top_images_dataset_lookup_bad_key(top_images_dataset, layer, unit,
         top_images_dataset.lookup(layer, unit)
 
 
+def test_top_images_dataset_unit(top_images_dataset):
+    """Test TopImagesDataset.unit returns layer and unit of sample."""
+    for index, sample in enumerate(top_images_dataset.samples):
+        assert top_images_dataset.unit(index) == (sample.layer, sample.unit)
+
+
+@pytest.mark.parametrize('indices', ((), (0,), (4, 1, 3), range(2, 5)))
+def test_top_images_dataset_units(top_images_dataset, indices):
+    """Test TopImagesDataset.units returns layers and units in order."""
+    actual = top_images_dataset.units(indices)
+    expected = tuple((top_images_dataset[index].layer,
+                      top_images_dataset[index].unit) for index in indices)
+    assert actual == expected
+
+
 def test_top_images_dataset_k(top_images_dataset):
     """Test TopImagesDataset.k returns number of top images."""
     assert top_images_dataset.k == conftest.N_TOP_IMAGES_PER_UNIT
@@ -0,0 +1,158 @@
+"""Unit tests for the `src.utils.ablations` module."""
+import collections
+
+from src.utils import ablations
+
+import pytest
+import torch
+from torch import nn
+from torch.utils import data
+
+BATCH_SIZE = 4
+N_CHANNELS = 5
+IMAGE_SIZE = 8
+N_CLASSES = 3
+N_IMAGES = 10
+
+
+def test_zero_each():
+    """Test zero_each zeros a different set of units in each copy."""
+    features = torch.rand(BATCH_SIZE, N_CHANNELS, 2, 2) + 1
+    fn = ablations.zero_each([[0], [], [1, 3]], tile=True)
+    actual = fn(features).view(3, BATCH_SIZE, N_CHANNELS, 2, 2)
+    for copy, units in enumerate(([0], [], [1, 3])):
+        for unit in range(N_CHANNELS):
+            if unit in units:
+                assert actual[copy, :, unit].eq(0).all()
+            else:
+                assert actual[copy, :, unit].equal(features[:, unit])
+
+
+def test_zero_each_bad_features():
+    """Test zero_each dies on non-4D features."""
+    fn = ablations.zero_each([[0]])
+    with pytest.raises(ValueError, match='.*4D.*'):
+        fn(torch.rand(BATCH_SIZE, N_CHANNELS))
+
+
+@pytest.fixture
+def classifier():
+    """Return a small ImageClassifier for testing."""
+    model = nn.Sequential(
+        collections.OrderedDict([
+            ('conv1', nn.Conv2d(3, N_CHANNELS, 3)),
+            ('relu1', nn.ReLU()),
+            ('conv2', nn.Conv2d(N_CHANNELS, N_CHANNELS, 3)),
+            ('relu2', nn.ReLU()),
+            ('pool', nn.AdaptiveAvgPool2d(1)),
+            ('flatten', nn.Flatten()),
+            ('fc', nn.Linear(N_CHANNELS, N_CLASSES)),
+        ]))
+    return ablations.ImageClassifier(model).eval()
+
+
+@pytest.fixture
+def images_dataset():
+    """Return a small dataset of images and labels for testing."""
+    images = torch.rand(N_IMAGES, 3, IMAGE_SIZE, IMAGE_SIZE)
+    labels = torch.randint(N_CLASSES, size=(N_IMAGES,))
+    return data.TensorDataset(images, labels)
+
+
+ABLATIONS = (
+    (),
+    (('conv1', 0),),
+    (('conv2', 1), ('conv2', 4)),
+    (('conv1', 2), ('conv2', 3)),
+)
+
+
+@pytest.mark.parametrize('ablations_per_batch', (1, 2, len(ABLATIONS)))
+def test_image_classifier_predict_ablations(classifier, images_dataset,
+                                            ablations_per_batch):
+    """Test ImageClassifier.predict_ablations matches ablating one by one."""
+    actual = classifier.predict_ablations(
+        images_dataset,
+        ABLATIONS,
+        batch_size=BATCH_SIZE,
+        ablations_per_batch=ablations_per_batch,
+        display_progress_as=None)
+    assert actual.shape == (len(ABLATIONS), N_IMAGES)
+    for units, predictions in zip(ABLATIONS, actual):
+        expected = classifier.predict(images_dataset,
+                                      batch_size=BATCH_SIZE,
+                                      ablate=units,
+                                      display_progress_as=None)
+        assert predictions.equal(expected)
+
+
+def test_image_classifier_predict_ablations_out_of_memory(
+        classifier, images_dataset):
+    """Test ImageClassifier.predict_ablations shrinks chunks on OOM."""
+
+    def hook(module, inputs, outputs):
+        if len(outputs) > 2 * BATCH_SIZE:
+            raise RuntimeError('CUDA out of memory (fake)')
+
+    classifier.model.fc.register_forward_hook(hook)
+    actual = classifier.predict_ablations(images_dataset,
+                                          ABLATIONS,
+                                          batch_size=BATCH_SIZE,
+                                          ablations_per_batch=len(ABLATIONS),
+                                          display_progress_as=None)
+    for units, predictions in zip(ABLATIONS, actual):
+        expected = classifier.predict(images_dataset,
+                                      batch_size=BATCH_SIZE,
+                                      ablate=units,
+                                      display_progress_as=None)
+        assert predictions.equal(expected)
+
+
+def test_image_classifier_predict_ablations_other_errors(
+        classifier, images_dataset):
+    """Test ImageClassifier.predict_ablations reraises non-OOM errors."""
+
+    def hook(module, inputs, outputs):
+        raise RuntimeError('something else')
+
+    classifier.model.fc.register_forward_hook(hook)
+    with pytest.raises(RuntimeError, match='.*something else.*'):
+        classifier.predict_ablations(images_dataset,
+                                     ABLATIONS,
+                                     batch_size=BATCH_SIZE,
+                                     display_progress_as=None)
+
+
+def test_image_classifier_predict_ablations_bad_ablations_per_batch(
+        classifier, images_dataset):
+    """Test ImageClassifier.predict_ablations dies on bad chunk size."""
+    with pytest.raises(ValueError, match='.*ablations_per_batch.*'):
+        classifier.predict_ablations(images_dataset,
+                                     ABLATIONS,
+                                     ablations_per_batch=0,
+                                     display_progress_as=None)
+
+
+def test_image_classifier_predict_ablations_empty(classifier,
+                                                  images_dataset):
+    """Test ImageClassifier.predict_ablations handles no ablations."""
+    actual = classifier.predict_ablations(images_dataset, (),
+                                          display_progress_as=None)
+    assert actual.shape == (0, N_IMAGES)
+    assert classifier.accuracy_ablations(images_dataset, (),
+                                         display_progress_as=None) == []
+
+
+def test_image_classifier_accuracy_ablations(classifier, images_dataset):
+    """Test ImageClassifier.accuracy_ablations matches ablating one by one."""
+    actual = classifier.accuracy_ablations(images_dataset,
+                                           ABLATIONS,
+                                           batch_size=BATCH_SIZE,
+                                           display_progress_as=None)
+    expected = [
+        classifier.accuracy(images_dataset,
+                            batch_size=BATCH_SIZE,
+                            ablate=units,
+                            display_progress_as=None) for units in ABLATIONS
+    ]
+    assert actual == expected
@@ -1,6 +1,8 @@
 """Unit tests for the `src.utils.training` module."""
 from src.utils import training
 
+import pytest
+
 PATIENCE = 5
 
 
@@ -58,3 +60,21 @@ def test_early_stopping_improved():
 
     early_stopping(-1)
     assert early_stopping.improved
+
+
+@pytest.mark.parametrize('start,stop,step,expected', (
+    (0, 1, .25, [0, .25, .5, .75]),
+    (.05, .5, .1, [.05, .15, .25, .35, .45]),
+    (.1, .12, .1, [.1]),
+    (.5, .5, .1, []),
+))
+def test_step_grid(start, stop, step, expected):
+    """Test step_grid keeps every point on the step grid."""
+    actual = training.step_grid(start, stop, step)
+    assert actual == pytest.approx(expected)
+
+
+def test_step_grid_bad_step():
+    """Test step_grid dies on non-positive step."""
+    with pytest.raises(ValueError, match='.*step.*'):
+        training.step_grid(0, 1, 0)